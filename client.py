@@ -1,38 +1,79 @@
 import asyncio
 import logging
 import os
+import signal
 import ssl
-import json
+import aiofiles
+import msgspec
+import orjson
 from aiortc import (
     RTCPeerConnection,
     RTCSessionDescription,
     RTCIceCandidate,
     MediaStreamTrack,
     RTCConfiguration,
+    RTCBundlePolicy,
     RTCIceServer,
-    RTCDataChannel
+    RTCDataChannel,
+    RTCSctpTransport
 )
-from aiortc.contrib.signaling import TcpSocketSignaling
+from aiortc.contrib.signaling import BYE, TcpSocketSignaling
 from aiortc.contrib.media import MediaPlayer, MediaRecorder
 from aiortc.mediastreams import MediaStreamError
+from common import (
+    CONTROL_MESSAGE_DECODER,
+    TextMessage,
+    FileStart,
+    FileEnd,
+    safe_received_path,
+    write_chunks,
+    coalesce_file_chunks,
+    open_received_file,
+    close_received_file
+)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("LLM-Transceiver-Client")
 
+# File transfer tuning
+FILE_CHUNK_SIZE = 256 * 1024  # Capped by the SCTP max message size
+OUTGOING_QUEUE_SIZE = 32  # Messages queued ahead of the data channel
+BUFFERED_AMOUNT_LOW_THRESHOLD = 1024 * 1024  # Resume sending below this
+BUFFERED_AMOUNT_HIGH_THRESHOLD = 4 * 1024 * 1024  # Pause sending above this
+
+# Prebuilt control message for the end of a file transfer
+FILE_END_MESSAGE = orjson.dumps({"type": "file_end"}).decode()
+
 class Client:
     def __init__(self, signaling):
         """
         Initialize the Client with signaling mechanism and peer connection.
         """
         self.signaling = signaling
-        self.pc = RTCPeerConnection()
+        self.pc = RTCPeerConnection(configuration=RTCConfiguration(
+            bundlePolicy=RTCBundlePolicy.MAX_BUNDLE
+        ))
         self.media_player = None
         self.media_recorder = None
         self.data_channel = None
         self.connected = asyncio.Event()
-        self.lock = asyncio.Lock()
-        self.file_buffer = bytearray()
+        self.shutdown = asyncio.Event()
+        self.remote_description_set = asyncio.Event()
+        self.pending_remote_candidates = []
+        self.message_queue = asyncio.Queue()
+        self.message_worker = None
+        self.outgoing_queue = asyncio.Queue(maxsize=OUTGOING_QUEUE_SIZE)
+        self.writer_task = None
+        self.signaling_task = None
+        self.file_lock = asyncio.Lock()
+        self.buffered_amount_low = asyncio.Event()
+        self.file_fd = None
         self.receiving_file = False
         self.received_file_path = 'received_file.bin'  # Default path
 
@@ -48,36 +89,94 @@ class Client:
         elif self.pc.iceConnectionState == 'failed':
             await self.pc.close()
             self.connected.clear()
+            self.shutdown.set()
 
     def on_datachannel(self, channel: RTCDataChannel):
         logger.info(f"Data channel received: {channel.label}")
 
         @channel.on("message")
         def on_message(message):
-            asyncio.create_task(self.handle_datachannel_message(message, channel))
+            self.message_queue.put_nowait((message, channel))
+
+    async def drain_messages(self):
+        """
+        Handle queued data channel messages one at a time, in arrival order.
+
+        Everything already waiting in the queue is taken as one batch, so
+        consecutive file chunks can be written to disk together.
+        """
+        while True:
+            batch = [await self.message_queue.get()]
+            while not self.message_queue.empty():
+                batch.append(self.message_queue.get_nowait())
+
+            for item in coalesce_file_chunks(batch):
+                if item is None:
+                    return
+                message, channel = item
+                try:
+                    if isinstance(message, list):
+                        await self.handle_file_chunks(message)
+                    else:
+                        await self.handle_datachannel_message(message, channel)
+                except Exception as e:
+                    logger.exception(f"Failed to handle data channel message: {e}")
 
     async def handle_datachannel_message(self, message, channel):
         if isinstance(message, str):
-            data = json.loads(message)
-            if data.get("type") == "text":
-                logger.info(f"Received text message: {data.get('data')}")
-            elif data.get("type") == "file_start":
-                self.received_file_path = data.get("filename", "received_file.bin")
-                self.file_buffer = bytearray()
+            try:
+                control = CONTROL_MESSAGE_DECODER.decode(message)
+            except msgspec.DecodeError as e:
+                logger.warning(f"Ignoring invalid control message: {e}")
+                return
+            if isinstance(control, TextMessage):
+                logger.info(f"Received text message: {control.data}")
+            elif isinstance(control, FileStart):
+                self.received_file_path = safe_received_path(control.filename, "received_file.bin")
+                loop = asyncio.get_running_loop()
+                if self.file_fd is not None:
+                    await loop.run_in_executor(None, close_received_file, self.file_fd)
+                    # Never keep a closed fd around if opening the next file fails
+                    self.file_fd = None
+                    self.receiving_file = False
+                self.file_fd = await loop.run_in_executor(
+                    None, open_received_file, self.received_file_path, control.size
+                )
                 self.receiving_file = True
                 logger.info(f"Starting file reception: {self.received_file_path}")
-            elif data.get("type") == "file_end":
-                with open(self.received_file_path, 'wb') as f:
-                    f.write(self.file_buffer)
+            elif isinstance(control, FileEnd):
+                if self.file_fd is None:
+                    logger.warning("Received file_end without a file transfer in progress")
+                    return
+                await asyncio.get_running_loop().run_in_executor(None, close_received_file, self.file_fd)
+                self.file_fd = None
                 self.receiving_file = False
                 logger.info(f"File received and saved to {self.received_file_path}")
         else:
-            # Binary data (file chunks)
-            if self.receiving_file:
-                self.file_buffer.extend(message)
-                logger.debug(f"Received file chunk of size {len(message)} bytes")
-            else:
-                logger.warning("Received binary data but not in file reception mode")
+            # Binary data (a file chunk)
+            await self.handle_file_chunks([message])
+
+    async def handle_file_chunks(self, chunks):
+        """
+        Write a run of binary file chunks to the file being received, off
+        the event loop.
+        """
+        if self.receiving_file:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, write_chunks, self.file_fd, chunks)
+            except OSError as e:
+                # Abort rather than keep writing after a gap; later chunks
+                # and file_end are then rejected as out of reception mode
+                fd, self.file_fd = self.file_fd, None
+                self.receiving_file = False
+                logger.error(f"Failed to write {self.received_file_path}, aborting file reception: {e}")
+                await loop.run_in_executor(None, close_received_file, fd)
+                return
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received %d file chunks totalling %d bytes", len(chunks), sum(map(len, chunks)))
+        else:
+            logger.warning("Received binary data but not in file reception mode")
 
     def on_track(self, track: MediaStreamTrack):
         logger.info(f"Track received: {track.kind}")
@@ -91,6 +190,8 @@ class Client:
         """
         Start the client: establish connection and handle media.
         """
+        self.message_worker = asyncio.create_task(self.drain_messages())
+        self.writer_task = asyncio.create_task(self.write_messages())
         await self.exchange_signaling()
 
         # Wait for connection to be established
@@ -106,9 +207,12 @@ class Client:
         await self.signaling.connect()
 
         # Create data channel
-        self.data_channel = self.pc.createDataChannel('chat')
+        self.data_channel = self.pc.createDataChannel('chat', ordered=True)
+        self.data_channel.bufferedAmountLowThreshold = BUFFERED_AMOUNT_LOW_THRESHOLD
         self.data_channel.on("open", self.on_datachannel_open)
-        self.data_channel.on("message", lambda message: asyncio.create_task(self.handle_datachannel_message(message, self.data_channel)))
+        self.data_channel.on("bufferedamountlow", self.on_buffered_amount_low)
+        self.data_channel.on("close", self.on_datachannel_close)
+        self.data_channel.on("message", lambda message: self.message_queue.put_nowait((message, self.data_channel)))
 
         # Add local media tracks
         await self.add_local_tracks()
@@ -118,50 +222,57 @@ class Client:
         await self.pc.setLocalDescription(offer)
 
         # Send offer to the server
-        await self.signaling.send(json.dumps({
-            'sdp': self.pc.localDescription.sdp,
-            'type': self.pc.localDescription.type
-        }))
-
-        # Wait for the answer
-        response = await self.signaling.receive()
-        answer = json.loads(response)
-        await self.pc.setRemoteDescription(RTCSessionDescription(
-            sdp=answer['sdp'],
-            type=answer['type']
-        ))
+        await self.signaling.send(self.pc.localDescription)
+
+        # Receive the answer and any ICE candidates. This must start after
+        # the first send, which is what opens the signaling connection.
+        self.signaling_task = asyncio.create_task(self.receive_ice_candidates())
 
-        # Exchange ICE candidates
-        asyncio.create_task(self.exchange_ice_candidates())
+        # Wait for the answer, unless signaling ends first
+        answered = asyncio.create_task(self.remote_description_set.wait())
+        await asyncio.wait({self.signaling_task, answered}, return_when=asyncio.FIRST_COMPLETED)
+        if not answered.done():
+            answered.cancel()
+            self.signaling_task.result()  # Re-raise a signaling error, if any
+            raise ConnectionError("Signaling channel closed before the answer arrived")
 
-    async def exchange_ice_candidates(self):
+    async def handle_signaling_message(self, message):
         """
-        Exchange ICE candidates with the server.
+        Apply a remote SDP or ICE candidate received over signaling.
+
+        Candidates that arrive before the remote description are held back
+        and added once it has been set.
         """
-        async def send_ice_candidates():
-            while True:
-                candidate = await self.pc.sctp.transport.getRemoteCandidate()
-                if candidate is None:
-                    break
-                await self.signaling.send(json.dumps({
-                    'candidate': candidate.to_sdp(),
-                    'sdpMid': candidate.sdpMid,
-                    'sdpMLineIndex': candidate.sdpMLineIndex
-                }))
-
-        asyncio.create_task(send_ice_candidates())
+        if isinstance(message, RTCSessionDescription):
+            await self.pc.setRemoteDescription(message)
+            for candidate in self.pending_remote_candidates:
+                await self.pc.addIceCandidate(candidate)
+            self.pending_remote_candidates = []
+            self.remote_description_set.set()
+            return
+
+        if isinstance(message, RTCIceCandidate):
+            if self.remote_description_set.is_set():
+                await self.pc.addIceCandidate(message)
+            else:
+                self.pending_remote_candidates.append(message)
 
+    async def receive_ice_candidates(self):
+        """
+        Read signaling messages from the server until the channel closes.
+
+        This is the only reader of the signaling channel, so it applies the
+        server's answer as well as any trickled RTCIceCandidate objects that
+        the signaling layer parses. aiortc itself does not trickle: both
+        peers gather candidates during setLocalDescription and send them
+        inside the SDP.
+        """
         while True:
             message = await self.signaling.receive()
-            if message is None:
+            if message is None or message is BYE:
+                logger.info("Signaling channel closed")
                 break
-            data = json.loads(message)
-            candidate = RTCIceCandidate(
-                sdpMid=data['sdpMid'],
-                sdpMLineIndex=data['sdpMLineIndex'],
-                candidate=data['candidate']
-            )
-            await self.pc.addIceCandidate(candidate)
+            await self.handle_signaling_message(message)
 
     async def add_local_tracks(self):
         """
@@ -185,41 +296,78 @@ class Client:
     async def on_datachannel_open(self):
         logger.info("Data channel is open")
 
+    def on_buffered_amount_low(self):
+        self.buffered_amount_low.set()
+
+    def on_datachannel_close(self):
+        logger.info("Data channel is closed")
+        # Wake the writer so it does not wait on a buffer that will never drain
+        self.buffered_amount_low.set()
+
+    async def write_messages(self):
+        """
+        Send queued messages over the data channel, in order.
+
+        This is the only place that writes to the data channel. Text messages
+        queued during a file transfer go out between its chunks instead of
+        waiting for the whole file.
+        """
+        while True:
+            message = await self.outgoing_queue.get()
+            if self.data_channel.readyState != 'open':
+                logger.warning("Data channel closed, dropping outgoing message")
+                continue
+            try:
+                self.data_channel.send(message)
+            except Exception as e:
+                logger.warning(f"Failed to send on data channel: {e}")
+                continue
+
+            # Back off until the SCTP send buffer drains or the channel closes;
+            # the next message rechecks readyState either way
+            if self.data_channel.bufferedAmount > BUFFERED_AMOUNT_HIGH_THRESHOLD:
+                self.buffered_amount_low.clear()
+                await self.buffered_amount_low.wait()
+
     async def send_text(self, message):
         """
         Send a text message over the data channel.
         """
-        async with self.lock:
-            if self.data_channel and self.data_channel.readyState == 'open':
-                data = json.dumps({"type": "text", "data": message})
-                self.data_channel.send(data)
-                logger.info(f"Sent text message: {message}")
-            else:
-                logger.warning("Data channel is not open")
+        if self.data_channel and self.data_channel.readyState == 'open':
+            data = orjson.dumps({"type": "text", "data": message}).decode()
+            await self.outgoing_queue.put(data)
+            logger.info(f"Sent text message: {message}")
+        else:
+            logger.warning("Data channel is not open")
 
     async def send_file(self, file_path):
         """
         Send a file over the data channel.
         """
-        async with self.lock:
+        filename = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        start_message = orjson.dumps({"type": "file_start", "filename": filename, "size": file_size}).decode()
+
+        # Only one file at a time, since chunks carry no file identifier
+        async with self.file_lock:
             if self.data_channel and self.data_channel.readyState == 'open':
-                filename = os.path.basename(file_path)
                 # Notify server of incoming file
-                start_message = json.dumps({"type": "file_start", "filename": filename})
-                self.data_channel.send(start_message)
+                await self.outgoing_queue.put(start_message)
 
                 # Send file data in chunks
-                with open(file_path, 'rb') as f:
+                chunk_size = min(FILE_CHUNK_SIZE, RTCSctpTransport.getCapabilities().maxMessageSize)
+                async with aiofiles.open(file_path, 'rb') as f:
                     while True:
-                        chunk = f.read(16384)
+                        if self.data_channel.readyState != 'open':
+                            logger.warning(f"Data channel closed, aborting file transfer: {file_path}")
+                            return
+                        chunk = await f.read(chunk_size)
                         if not chunk:
                             break
-                        self.data_channel.send(chunk)
-                        await asyncio.sleep(0)  # Yield control to event loop
+                        await self.outgoing_queue.put(chunk)
 
                 # Notify server that file transmission is complete
-                end_message = json.dumps({"type": "file_end"})
-                self.data_channel.send(end_message)
+                await self.outgoing_queue.put(FILE_END_MESSAGE)
                 logger.info(f"Sent file: {file_path}")
             else:
                 logger.warning("Data channel is not open")
@@ -228,6 +376,19 @@ class Client:
         """
         Stop media processing and close the connection.
         """
+        if self.message_worker:
+            self.message_queue.put_nowait(None)
+            await self.message_worker
+        if self.file_fd is not None:
+            # Keep what arrived of an interrupted transfer, without the preallocated tail
+            await asyncio.get_running_loop().run_in_executor(None, close_received_file, self.file_fd)
+            self.file_fd = None
+            self.receiving_file = False
+            logger.warning(f"File transfer interrupted, partial file left at {self.received_file_path}")
+        if self.writer_task:
+            self.writer_task.cancel()
+        if self.signaling_task:
+            self.signaling_task.cancel()
         if self.media_recorder:
             await self.media_recorder.stop()
         if self.media_player:
@@ -252,15 +413,24 @@ async def run_client():
         # Example: Send a file
         await client.send_file('path_to_file.txt')
 
-        # Keep the client running until interrupted
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("Client interrupted by user")
+        # Keep the client running until interrupted or the connection fails
+        loop = asyncio.get_running_loop()
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, client.shutdown.set)
+        except NotImplementedError:
+            pass  # Not supported on Windows; Ctrl+C is handled by asyncio.run
+        await client.shutdown.wait()
+        logger.info("Client shutting down")
     except Exception as e:
         logger.exception(f"An error occurred: {e}")
     finally:
         await client.stop()
 
 if __name__ == '__main__':
-    asyncio.run(run_client())
+    if uvloop and hasattr(uvloop, 'run'):
+        uvloop.run(run_client())
+    else:
+        if uvloop:
+            uvloop.install()  # uvloop < 0.18 has no run()
+        asyncio.run(run_client())
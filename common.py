@@ -0,0 +1,125 @@
+"""
+Helpers shared by client.py and server.py: data channel message types
+and received-file handling.
+"""
+import os
+from typing import Annotated, Optional, Union
+import msgspec
+
+# Largest announced file size that is reserved on disk up front; bigger
+# files are still received, just without preallocation
+MAX_PREALLOCATED_SIZE = 4 * 1024 ** 3
+
+# Data channel control messages, decoded by their "type" tag
+class TextMessage(msgspec.Struct, tag='text'):
+    data: str = ''
+
+class FileStart(msgspec.Struct, tag='file_start'):
+    filename: Optional[str] = None
+    size: Optional[Annotated[int, msgspec.Meta(ge=0)]] = None
+
+class FileEnd(msgspec.Struct, tag='file_end'):
+    pass
+
+CONTROL_MESSAGE_DECODER = msgspec.json.Decoder(Union[TextMessage, FileStart, FileEnd])
+
+# Directory that incoming files are confined to
+RECEIVED_FILES_DIR = 'received_files'
+
+def safe_received_path(filename, default):
+    """
+    Map a peer-supplied filename to a path inside RECEIVED_FILES_DIR.
+    """
+    name = os.path.basename(filename or '')
+    if name in ('', '.', '..'):
+        name = default
+    return os.path.join(RECEIVED_FILES_DIR, name)
+
+def write_all(fd, data):
+    """
+    Write all of data to fd, retrying on partial writes.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+# Most buffers a single writev call accepts
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16  # POSIX minimum
+
+def write_chunks(fd, chunks):
+    """
+    Write a list of buffers to fd in order, retrying on partial writes.
+
+    Uses os.writev where available so the buffers reach the file without
+    first being joined into one.
+    """
+    if not hasattr(os, 'writev'):
+        for chunk in chunks:
+            write_all(fd, chunk)
+        return
+    views = [memoryview(chunk) for chunk in chunks if chunk]
+    i = 0
+    while i < len(views):
+        written = os.writev(fd, views[i:i + IOV_MAX])
+        # Skip the buffers written in full, then trim a partially written one
+        while i < len(views) and written >= len(views[i]):
+            written -= len(views[i])
+            i += 1
+        if written:
+            views[i] = views[i][written:]
+
+# A run of file chunks is written out once it reaches this many bytes
+MAX_COALESCED_BYTES = 1024 * 1024
+
+def coalesce_file_chunks(batch):
+    """
+    Yield queued (message, channel) items in order, gathering runs of binary
+    file chunks into lists to be written with a single write_chunks call.
+
+    A run is cut as soon as it reaches MAX_COALESCED_BYTES, so it can
+    exceed that limit by up to one chunk.
+    """
+    chunks, channel, size = [], None, 0
+    for item in batch:
+        if item is not None and isinstance(item[0], bytes):
+            chunks.append(item[0])
+            channel = item[1]
+            size += len(item[0])
+            if size >= MAX_COALESCED_BYTES:
+                yield chunks, channel
+                chunks, size = [], 0
+            continue
+        if chunks:
+            yield chunks, channel
+            chunks, size = [], 0
+        yield item
+    if chunks:
+        yield chunks, channel
+
+def open_received_file(path, size):
+    """
+    Open path for writing, reserving size bytes up front when it is known
+    and no larger than MAX_PREALLOCATED_SIZE.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        if size and size <= MAX_PREALLOCATED_SIZE and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+def close_received_file(fd):
+    """
+    Drop any preallocated space the sender did not fill, then close fd.
+    """
+    os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+    os.close(fd)
@@ -1,20 +1,40 @@
 import asyncio
 import logging
 import os
+import signal
 import ssl
-import json
+import uuid
+import msgspec
+import orjson
 from aiortc import (
     RTCPeerConnection,
     RTCSessionDescription,
     RTCIceCandidate,
     MediaStreamTrack,
     RTCConfiguration,
+    RTCBundlePolicy,
     RTCIceServer,
     RTCDataChannel
 )
-from aiortc.contrib.signaling import TcpSocketSignaling
+from aiortc.contrib.signaling import BYE, TcpSocketSignaling
 from aiortc.contrib.media import MediaPlayer, MediaRecorder
 from aiortc.mediastreams import MediaStreamError
+from common import (
+    CONTROL_MESSAGE_DECODER,
+    TextMessage,
+    FileStart,
+    FileEnd,
+    safe_received_path,
+    write_chunks,
+    coalesce_file_chunks,
+    open_received_file,
+    close_received_file
+)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,13 +46,21 @@ class Server:
         Initialize the Server with signaling mechanism and peer connection.
         """
         self.signaling = signaling
-        self.pc = RTCPeerConnection()
+        self.pc = RTCPeerConnection(configuration=RTCConfiguration(
+            bundlePolicy=RTCBundlePolicy.MAX_BUNDLE
+        ))
         self.media_player = None
+        self.recording_path = None
         self.media_recorder = None
         self.data_channel = None
         self.connected = asyncio.Event()
-        self.lock = asyncio.Lock()
-        self.file_buffer = bytearray()
+        self.shutdown = asyncio.Event()
+        self.remote_description_set = asyncio.Event()
+        self.pending_remote_candidates = []
+        self.message_queue = asyncio.Queue()
+        self.message_worker = None
+        self.signaling_task = None
+        self.file_fd = None
         self.receiving_file = False
         self.received_file_path = 'server_received_file.bin'  # Default path
 
@@ -48,32 +76,72 @@ class Server:
         elif self.pc.iceConnectionState == 'failed':
             await self.pc.close()
             self.connected.clear()
+            self.shutdown.set()
 
     def on_datachannel(self, channel: RTCDataChannel):
         logger.info(f"Data channel received: {channel.label}")
 
         @channel.on("message")
         def on_message(message):
-            asyncio.create_task(self.handle_datachannel_message(message, channel))
+            self.message_queue.put_nowait((message, channel))
+
+    async def drain_messages(self):
+        """
+        Handle queued data channel messages one at a time, in arrival order.
+
+        Everything already waiting in the queue is taken as one batch, so
+        consecutive file chunks can be written to disk together.
+        """
+        while True:
+            batch = [await self.message_queue.get()]
+            while not self.message_queue.empty():
+                batch.append(self.message_queue.get_nowait())
+
+            for item in coalesce_file_chunks(batch):
+                if item is None:
+                    return
+                message, channel = item
+                try:
+                    if isinstance(message, list):
+                        await self.handle_file_chunks(message)
+                    else:
+                        await self.handle_datachannel_message(message, channel)
+                except Exception as e:
+                    logger.exception(f"Failed to handle data channel message: {e}")
 
     async def handle_datachannel_message(self, message, channel):
         if isinstance(message, str):
-            data = json.loads(message)
-            if data.get("type") == "text":
-                text = data.get("data")
+            try:
+                control = CONTROL_MESSAGE_DECODER.decode(message)
+            except msgspec.DecodeError as e:
+                logger.warning(f"Ignoring invalid control message: {e}")
+                return
+            if isinstance(control, TextMessage):
+                text = control.data
                 logger.info(f"Received text message: {text}")
 
                 # Process the text with LLM (placeholder for actual LLM processing)
                 response_text = self.process_text_with_llm(text)
                 await self.send_text(response_text)
-            elif data.get("type") == "file_start":
-                self.received_file_path = data.get("filename", "server_received_file.bin")
-                self.file_buffer = bytearray()
+            elif isinstance(control, FileStart):
+                self.received_file_path = safe_received_path(control.filename, "server_received_file.bin")
+                loop = asyncio.get_running_loop()
+                if self.file_fd is not None:
+                    await loop.run_in_executor(None, close_received_file, self.file_fd)
+                    # Never keep a closed fd around if opening the next file fails
+                    self.file_fd = None
+                    self.receiving_file = False
+                self.file_fd = await loop.run_in_executor(
+                    None, open_received_file, self.received_file_path, control.size
+                )
                 self.receiving_file = True
                 logger.info(f"Starting file reception: {self.received_file_path}")
-            elif data.get("type") == "file_end":
-                with open(self.received_file_path, 'wb') as f:
-                    f.write(self.file_buffer)
+            elif isinstance(control, FileEnd):
+                if self.file_fd is None:
+                    logger.warning("Received file_end without a file transfer in progress")
+                    return
+                await asyncio.get_running_loop().run_in_executor(None, close_received_file, self.file_fd)
+                self.file_fd = None
                 self.receiving_file = False
                 logger.info(f"File received and saved to {self.received_file_path}")
 
@@ -81,25 +149,47 @@ class Server:
                 response_text = self.process_file_with_llm(self.received_file_path)
                 await self.send_text(response_text)
         else:
-            # Binary data (file chunks)
-            if self.receiving_file:
-                self.file_buffer.extend(message)
-                logger.debug(f"Received file chunk of size {len(message)} bytes")
-            else:
-                logger.warning("Received binary data but not in file reception mode")
+            # Binary data (a file chunk)
+            await self.handle_file_chunks([message])
+
+    async def handle_file_chunks(self, chunks):
+        """
+        Write a run of binary file chunks to the file being received, off
+        the event loop.
+        """
+        if self.receiving_file:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, write_chunks, self.file_fd, chunks)
+            except OSError as e:
+                # Abort rather than keep writing after a gap; later chunks
+                # and file_end are then rejected as out of reception mode
+                fd, self.file_fd = self.file_fd, None
+                self.receiving_file = False
+                logger.error(f"Failed to write {self.received_file_path}, aborting file reception: {e}")
+                await loop.run_in_executor(None, close_received_file, fd)
+                return
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received %d file chunks totalling %d bytes", len(chunks), sum(map(len, chunks)))
+        else:
+            logger.warning("Received binary data but not in file reception mode")
 
     def on_track(self, track: MediaStreamTrack):
         logger.info(f"Track received: {track.kind}")
 
         if track.kind == "audio" or track.kind == "video":
             if not self.media_recorder:
-                self.media_recorder = MediaRecorder('server_received_media.mp4')
+                # One recording per connection, so reconnects never truncate an earlier one
+                self.recording_path = f'server_received_{uuid.uuid4().hex}.mp4'
+                self.media_recorder = MediaRecorder(self.recording_path)
+                logger.info(f"Recording media to {self.recording_path}")
             self.media_recorder.addTrack(track)
 
     async def start(self):
         """
         Start the server: accept connection and handle media.
         """
+        self.message_worker = asyncio.create_task(self.drain_messages())
         await self.exchange_signaling()
 
         # Wait for connection to be established
@@ -114,56 +204,60 @@ class Server:
         """
         await self.signaling.connect()
 
-        # Wait for the offer from the client
-        request = await self.signaling.receive()
-        offer = json.loads(request)
-        await self.pc.setRemoteDescription(RTCSessionDescription(
-            sdp=offer['sdp'],
-            type=offer['type']
-        ))
+        # Wait for the offer from the client, holding any early ICE candidates
+        while not self.remote_description_set.is_set():
+            request = await self.signaling.receive()
+            if request is None or request is BYE:
+                raise ConnectionError("Signaling channel closed before the offer arrived")
+            await self.handle_signaling_message(request)
 
         # Create answer and set local description
         await self.add_local_tracks()
         answer = await self.pc.createAnswer()
         await self.pc.setLocalDescription(answer)
 
+        # Receive ICE candidates while the answer is in flight
+        self.signaling_task = asyncio.create_task(self.receive_ice_candidates())
+
         # Send answer back to the client
-        await self.signaling.send(json.dumps({
-            'sdp': self.pc.localDescription.sdp,
-            'type': self.pc.localDescription.type
-        }))
+        await self.signaling.send(self.pc.localDescription)
 
-        # Exchange ICE candidates
-        asyncio.create_task(self.exchange_ice_candidates())
+    async def handle_signaling_message(self, message):
+        """
+        Apply a remote SDP or ICE candidate received over signaling.
 
-    async def exchange_ice_candidates(self):
+        Candidates that arrive before the remote description are held back
+        and added once it has been set.
         """
-        Exchange ICE candidates with the client.
+        if isinstance(message, RTCSessionDescription):
+            await self.pc.setRemoteDescription(message)
+            for candidate in self.pending_remote_candidates:
+                await self.pc.addIceCandidate(candidate)
+            self.pending_remote_candidates = []
+            self.remote_description_set.set()
+            return
+
+        if isinstance(message, RTCIceCandidate):
+            if self.remote_description_set.is_set():
+                await self.pc.addIceCandidate(message)
+            else:
+                self.pending_remote_candidates.append(message)
+
+    async def receive_ice_candidates(self):
         """
-        async def send_ice_candidates():
-            while True:
-                candidate = await self.pc.sctp.transport.getRemoteCandidate()
-                if candidate is None:
-                    break
-                await self.signaling.send(json.dumps({
-                    'candidate': candidate.to_sdp(),
-                    'sdpMid': candidate.sdpMid,
-                    'sdpMLineIndex': candidate.sdpMLineIndex
-                }))
-
-        asyncio.create_task(send_ice_candidates())
+        Read signaling messages from the client until the channel closes.
 
+        Trickled RTCIceCandidate objects parsed by the signaling layer are
+        applied as they arrive. aiortc itself does not trickle: both peers
+        gather candidates during setLocalDescription and send them inside
+        the SDP.
+        """
         while True:
             message = await self.signaling.receive()
-            if message is None:
+            if message is None or message is BYE:
+                logger.info("Signaling channel closed")
                 break
-            data = json.loads(message)
-            candidate = RTCIceCandidate(
-                sdpMid=data['sdpMid'],
-                sdpMLineIndex=data['sdpMLineIndex'],
-                candidate=data['candidate']
-            )
-            await self.pc.addIceCandidate(candidate)
+            await self.handle_signaling_message(message)
 
     async def add_local_tracks(self):
         """
@@ -183,18 +277,28 @@ class Server:
         """
         Send a text message over the data channel.
         """
-        async with self.lock:
-            if self.data_channel and self.data_channel.readyState == 'open':
-                data = json.dumps({"type": "text", "data": message})
-                self.data_channel.send(data)
-                logger.info(f"Sent text message: {message}")
-            else:
-                logger.warning("Data channel is not open")
+        if self.data_channel and self.data_channel.readyState == 'open':
+            data = orjson.dumps({"type": "text", "data": message}).decode()
+            self.data_channel.send(data)
+            logger.info(f"Sent text message: {message}")
+        else:
+            logger.warning("Data channel is not open")
 
     async def stop(self):
         """
         Stop media processing and close the connection.
         """
+        if self.message_worker:
+            self.message_queue.put_nowait(None)
+            await self.message_worker
+        if self.file_fd is not None:
+            # Keep what arrived of an interrupted transfer, without the preallocated tail
+            await asyncio.get_running_loop().run_in_executor(None, close_received_file, self.file_fd)
+            self.file_fd = None
+            self.receiving_file = False
+            logger.warning(f"File transfer interrupted, partial file left at {self.received_file_path}")
+        if self.signaling_task:
+            self.signaling_task.cancel()
         if self.media_recorder:
             await self.media_recorder.stop()
         if self.media_player:
@@ -231,7 +335,10 @@ class Server:
             str: The response text from the LLM after processing the file.
         """
         # Placeholder for LLM processing
-        # Replace this with actual LLM inference code
+        # Replace this with actual LLM inference code. To hand the file to a
+        # tokenizer without copying it, map it read-only, e.g.
+        # mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) (empty files cannot
+        # be mapped), and run that work in an executor to keep the event loop free.
         response = f"LLM processed file: {file_path}"
         return response
 
@@ -243,15 +350,24 @@ async def run_server():
     try:
         await server.start()
 
-        # Keep the server running until interrupted
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("Server interrupted by user")
+        # Keep the server running until interrupted or the connection fails
+        loop = asyncio.get_running_loop()
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, server.shutdown.set)
+        except NotImplementedError:
+            pass  # Not supported on Windows; Ctrl+C is handled by asyncio.run
+        await server.shutdown.wait()
+        logger.info("Server shutting down")
     except Exception as e:
         logger.exception(f"An error occurred: {e}")
     finally:
         await server.stop()
 
 if __name__ == '__main__':
-    asyncio.run(run_server())
+    if uvloop and hasattr(uvloop, 'run'):
+        uvloop.run(run_server())
+    else:
+        if uvloop:
+            uvloop.install()  # uvloop < 0.18 has no run()
+        asyncio.run(run_server())